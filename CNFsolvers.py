@@ -24,6 +24,7 @@ class MinisatSubsetSolver(object):
             self.dimacs = []
             self.groups = collections.defaultdict(list)
         self.read_dimacs(infile)
+        self.all_n = set(range(1, self.n+1))  # used in complement fairly frequently
         self._msolver = None
 
     def set_msolver(self, msolver):
@@ -120,7 +121,7 @@ class MinisatSubsetSolver(object):
             return is_sat
 
     def complement(self, aset):
-        return set(range(1, self.n+1)).difference(aset)
+        return self.all_n.difference(aset)
 
     def shrink(self, seed):
         hard = self._msolver.implies()
@@ -176,6 +177,10 @@ class MinisatSubsetSolver(object):
 
 
 class MUSerSubsetSolver(MinisatSubsetSolver):
+    # shrink() checks the seed against the map itself (returning None if
+    # it has been explored), so callers need not check first
+    shrink_checks_seed = True
+
     def __init__(self, filename, rand_seed=None, numthreads=1):
         MinisatSubsetSolver.__init__(self, filename, rand_seed, store_dimacs=True)
         self.core_pattern = re.compile(r'^v [\d ]+$', re.MULTILINE)
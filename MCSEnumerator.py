@@ -6,6 +6,7 @@ try:
 except ImportError:
     import Queue as queue
 
+import utils
 from pyminisolvers import minisolvers
 
 
@@ -19,6 +20,7 @@ class MCSEnumerator(object):
         self.nvars = csolver.nvars
         self.nclauses = csolver.nclauses
         self.n = csolver.n
+        self.all_n = set(range(1, self.n+1))  # used in complement fairly frequently
         self.groups = csolver.groups
         self.instrumented_solver = None
         self.stats = stats
@@ -34,7 +36,7 @@ class MCSEnumerator(object):
     def receive_thread(self):
         while self.pipe.poll(None):
             with self.stats.time('receive'):
-                res = self.pipe.recv()
+                res = utils.unpack_message(self.pipe.recv_bytes())
                 if res == 'terminate':
                     # exit process on terminate message
                     os._exit(0)
@@ -70,7 +72,7 @@ class MCSEnumerator(object):
             self.clauses.append(array.array('i', [int(i) for i in clause.split()[:-1]]))
 
     def complement(self, aset):
-        return set(range(1, self.n+1)).difference(aset)
+        return self.all_n.difference(aset)
 
     def setup_solver(self):
         solver = minisolvers.MinicardSubsetSolver()
@@ -136,6 +138,6 @@ class MCSEnumerator(object):
             k += 1
 
         if self.pipe:
-            self.pipe.send(('done', self.stats))
+            self.pipe.send_bytes(utils.pack_message(('done', self.stats)))
             # wait for receive thread to finish processing any incoming data until our "done" is acknowledged by the parent
             self.recv_thread.join()
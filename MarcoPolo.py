@@ -1,10 +1,8 @@
+import collections
 import os
 import threading
 
-try:
-    import queue
-except ImportError:
-    import Queue as queue
+import utils
 
 
 class MarcoPolo(object):
@@ -17,6 +15,11 @@ class MarcoPolo(object):
         self.bias_high = self.config['bias'] == 'MUSes'  # used frequently
         self.n = self.map.n   # number of constraints
         self.got_top = False  # track whether we've explored the complete set (top of the lattice)
+        # recheck seeds against results received from other enumerators
+        # (only possible if the hub forwards them and we actually use them)
+        self.recheck_seeds = pipe is not None and not self.config['comms_disable'] and not self.config['comms_ignore']
+        # (some subset solvers already recheck unsat seeds within shrink())
+        self.recheck_unsat = self.recheck_seeds and not getattr(csolver, 'shrink_checks_seed', False)
 
         self.pipe = pipe
         # if a pipe is provided, use it to receive results from other enumerators
@@ -27,9 +30,14 @@ class MarcoPolo(object):
     def receive_thread(self):
         while self.pipe.poll(None):
             with self.stats.time('receive'):
-                res = self.pipe.recv()
+                res = utils.unpack_message(self.pipe.recv_bytes())
                 if res == 'terminate':
-                    # exit process on terminate message
+                    # exit process on terminate message (os._exit() skips
+                    # atexit handlers, so let the subset solver save anything
+                    # it has not written out yet)
+                    close = getattr(self.subs, 'close', None)
+                    if close is not None:
+                        close()
                     os._exit(0)
                 # Otherwise, we've received another result,
                 # update blocking clauses.
@@ -57,49 +65,71 @@ class MarcoPolo(object):
     def enumerate(self):
         '''MUS/MCS enumeration with all the bells and whistles...'''
 
+        # settings that are fixed for the whole enumeration, looked up once
+        verbose = self.config['verbose']
+        # (not all subset solvers count their results)
+        increment_MSS = getattr(self.subs, 'increment_MSS', None)
+        increment_MUS = getattr(self.subs, 'increment_MUS', None)
+        # bound methods used on every iteration
+        check_subset = self.subs.check_subset
+        grow = self.subs.grow
+        shrink = self.subs.shrink
+        block_down = self.map.block_down
+        block_up = self.map.block_up
+        timer = self.stats.time
+        record_delta = self.record_delta
+        bias_high = self.bias_high
+
         for seed, known_max in self.seeds:
 
-            if self.config['verbose']:
+            if verbose:
                 print("- Initial seed: %s" % " ".join([str(x) for x in seed]))
 
-            with self.stats.time('check'):
+            with timer('check'):
                 # subset check may improve upon seed w/ unsat_core or sat_subset
                 oldlen = len(seed)
-                seed_is_sat, seed = self.subs.check_subset(seed, improve_seed=True)
-                self.record_delta('checkA', oldlen, len(seed), seed_is_sat)
-                known_max = (known_max and (seed_is_sat == self.bias_high))
+                seed_is_sat, seed = check_subset(seed, improve_seed=True)
+                seedlen = len(seed)  # (also the starting size for grow/shrink)
+                record_delta('checkA', oldlen, seedlen, seed_is_sat)
+                known_max = (known_max and (seed_is_sat == bias_high))
 
-            if self.config['verbose']:
+            if verbose:
                 print("- Seed is %s." % {True: "SAT", False: "UNSAT"}[seed_is_sat])
                 if known_max:
                     print("- Seed is known to be optimal.")
                 else:
                     print("- Seed improved by check: %s" % " ".join([str(x) for x in seed]))
 
+            if not known_max and (self.recheck_seeds if seed_is_sat else self.recheck_unsat):
+                # Another enumerator may have explored this seed since we
+                # got it from the map; if so, skip the grow()/shrink() work.
+                with timer('recheck'):
+                    explored = not self.map.check_seed(seed)
+                if explored:
+                    self.stats.increment_counter("parallel_rejected")
+                    continue
+
             if seed_is_sat:
                 if known_max:
                     MSS = seed
                 else:
-                    with self.stats.time('grow'):
-                        oldlen = len(seed)
-                        MSS = self.subs.grow(seed)
-                        self.record_delta('grow', oldlen, len(MSS), True)
+                    with timer('grow'):
+                        MSS = grow(seed)
+                        record_delta('grow', seedlen, len(MSS), True)
 
-                    if self.config['verbose']:
+                    if verbose:
                         print("- Grow() -> MSS")
 
-                with self.stats.time('block'):
+                with timer('block'):
                     res = ("S", MSS)
                     yield res
 
-                    try:
-                        self.subs.increment_MSS()
-                    except AttributeError:
-                        pass
+                    if increment_MSS is not None:
+                        increment_MSS()
 
-                    self.map.block_down(MSS)
+                    block_down(MSS)
 
-                if self.config['verbose']:
+                if verbose:
                     print("- MSS blocked.")
 
             else:  # seed is not SAT
@@ -107,10 +137,8 @@ class MarcoPolo(object):
                 if known_max:
                     MUS = seed
                 else:
-                    with self.stats.time('shrink'):
-                        oldlen = len(seed)
-
-                        MUS = self.subs.shrink(seed)
+                    with timer('shrink'):
+                        MUS = shrink(seed)
 
                         if MUS is None:
                             # seed was explored in another process
@@ -118,27 +146,25 @@ class MarcoPolo(object):
                             self.stats.increment_counter("parallel_rejected")
                             continue
 
-                        self.record_delta('shrink', oldlen, len(MUS), False)
+                        record_delta('shrink', seedlen, len(MUS), False)
 
-                    if self.config['verbose']:
+                    if verbose:
                         print("- Shrink() -> MUS")
 
-                with self.stats.time('block'):
+                with timer('block'):
                     res = ("U", MUS)
                     yield res
 
-                    try:
-                        self.subs.increment_MUS()
-                    except AttributeError:
-                        pass
+                    if increment_MUS is not None:
+                        increment_MUS()
 
-                    self.map.block_up(MUS)
+                    block_up(MUS)
 
-                if self.config['verbose']:
+                if verbose:
                     print("- MUS blocked.")
 
         if self.pipe:
-            self.pipe.send(('complete', self.stats))
+            self.pipe.send_bytes(utils.pack_message(('complete', self.stats)))
             self.recv_thread.join()
 
 
@@ -147,15 +173,17 @@ class SeedManager(object):
         self.map = msolver
         self.stats = stats
         self.config = config
-        self._seed_queue = queue.Queue()
+        self.maximize = config['maximize']  # fixed for the whole run
+        # only used by the enumerating thread, so no locking queue is needed
+        self._seed_queue = collections.deque()
 
     def __iter__(self):
         return self
 
     def __next__(self):
         with self.stats.time('seed'):
-            if not self._seed_queue.empty():
-                return self._seed_queue.get()
+            if self._seed_queue:
+                return self._seed_queue.popleft()
             else:
                 seed, known_max = self.seed_from_solver()
                 if seed is None:
@@ -163,11 +191,10 @@ class SeedManager(object):
                 return seed, known_max
 
     def add_seed(self, seed, known_max):
-        self._seed_queue.put((seed, known_max))
+        self._seed_queue.append((seed, known_max))
 
     def seed_from_solver(self):
-        known_max = self.config['maximize']
-        return self.map.next_seed(), known_max
+        return self.map.next_seed(), self.maximize
 
     # for python 2 compatibility
     next = __next__
@@ -1,56 +1,274 @@
+import atexit
+import binascii
+import errno
+import hashlib
+import multiprocessing
+import numbers
+import os
+import re
+import sqlite3
+import threading
+import utils
+from array import array
 from z3 import *
 
 
-def dimacs_var(i):
-    if i not in dimacs_var.cache:
-        if i > 0:
-            dimacs_var.cache[i] = Bool(str(i))
-        else:
-            dimacs_var.cache[i] = Not(Bool(str(-i)))
-    return dimacs_var.cache[i]
-dimacs_var.cache = {}
+def read_dimacs(filename):
+    # Tokenize the whole file at once rather than line by line: strip
+    # comment and header lines, convert all tokens, then split into
+    # clauses at each 0.
+    with open(filename, 'rb') as f:
+        data = f.read()
+    data = re.sub(br'^[cp].*$', b'', data, flags=re.MULTILINE)
+    ints = list(map(int, data.split()))
 
+    clauses = []
+    start = 0
+    try:
+        while True:
+            end = ints.index(0, start)
+            clauses.append(ints[start:end])
+            start = end + 1
+    except ValueError:
+        pass  # no more clauses
 
-def read_dimacs(filename):
-    formula = []
-    with open(filename) as f:
-        for line in f:
-            if line.startswith('c') or line.startswith('p'):
-                continue
-            clause = [int(x) for x in line.split()[:-1]]
-            formula.append( Or(dimacs_var(i) for i in clause) )
-    return formula
+    # positive and negative literals for every variable, indexed by variable number
+    nvars = max([abs(i) for clause in clauses for i in clause] or [0])
+    pos = [None] + [Bool(str(i)) for i in range(1, nvars+1)]
+    neg = [None] + [Not(v) for v in pos[1:]]
+
+    return [Or([pos[i] if i > 0 else neg[-i] for i in clause]) for clause in clauses]
 
 
 def read_smt2(filename):
     formula = parse_smt2_file(filename)
+    if isinstance(formula, AstVector):
+        # newer versions of z3 return a vector of the asserted formulas
+        formula = formula[0] if len(formula) == 1 else And(*formula)
     if is_and(formula):
         return formula.children()
     else:
         return [formula]
 
 
+class UBTree(object):
+    """Unlimited branching tree storing sets of integers, supporting
+    fast lookup of stored sets contained in a given query set.
+
+    Each set is stored as a path of its sorted elements from the root.
+    Nodes are indexes into flat int32 arrays holding each node's label,
+    first child, and next sibling, so a node takes the same space however
+    large its label is.
+    """
+    def __init__(self):
+        self._label = array('i', [0])   # per node: the element on the edge into it
+        self._first = array('i', [-1])  # per node: its first child (-1 = none)
+        self._next = array('i', [-1])   # per node: its next sibling (-1 = none)
+        self._end = {}                  # node: the set stored there
+
+    def insert(self, aset):
+        label = self._label
+        first = self._first
+        nxt = self._next
+        node = 0
+        for x in sorted(aset):
+            child = first[node]
+            while child >= 0 and label[child] != x:
+                child = nxt[child]
+            if child < 0:
+                child = len(label)
+                label.append(x)
+                first.append(-1)
+                nxt.append(first[node])
+                first[node] = child
+            node = child
+        self._end[node] = aset
+
+    def find_subset(self, mask):
+        """Return any stored set that is a subset of the one given as a
+        bitmask, or None."""
+        label = self._label
+        first = self._first
+        nxt = self._next
+        end = self._end
+        # the query's bits as bytes (lowest first), so each label is tested
+        # in constant time rather than with a shift or AND over the whole
+        # mask (built through hex, as int.to_bytes() is Python 3 only)
+        digits = '%x' % mask
+        if len(digits) % 2:
+            digits = '0' + digits
+        bits = bytearray(binascii.unhexlify(digits))
+        bits.reverse()
+        nbytes = len(bits)
+        # DFS following only edges labeled with elements of the query
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if node in end:
+                return end[node]
+            child = first[node]
+            while child >= 0:
+                x = label[child]
+                if x >> 3 < nbytes and bits[x >> 3] >> (x & 7) & 1:
+                    stack.append(child)
+                child = nxt[child]
+        return None
+
+
+class ResultCache(object):
+    """On-disk store of the unsat cores and satisfiable subsets found for
+    one input file, so later runs on the same input can reuse them.
+
+    Subsets are stored as bitmasks (in hex).  The cache for a file is
+    discarded if its number of constraints doesn't match.
+    """
+    def __init__(self, cache_dir, filename, n, batch_size=100):
+        with open(filename, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:16]
+        # (--parallel children all get here at once, so another may have
+        # just created the directory)
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        path = os.path.join(cache_dir, digest + '.sqlite')
+
+        # results are added from the enumeration thread but flushed at exit
+        # from the main thread
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (n INTEGER)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS results (mask TEXT PRIMARY KEY, is_sat INTEGER)")
+        row = self._db.execute("SELECT n FROM meta").fetchone()
+        if row is None or row[0] != n:
+            self._db.execute("DELETE FROM meta")
+            self._db.execute("DELETE FROM results")
+            self._db.execute("INSERT INTO meta VALUES (?)", (n,))
+            self._db.commit()
+
+        self._batch_size = batch_size
+        self._pending = 0
+        atexit.register(self.close)
+
+    def load(self):
+        """Return a list of (mask, is_sat) pairs for all stored results."""
+        with self._lock:
+            rows = self._db.execute("SELECT mask, is_sat FROM results").fetchall()
+        return [(int(mask, 16), bool(is_sat)) for mask, is_sat in rows]
+
+    def remove(self, masks):
+        """Drop the stored results for the given bitmasks."""
+        with self._lock:
+            if self._db is None:
+                return
+            self._db.executemany("DELETE FROM results WHERE mask = ?", [('%x' % mask,) for mask in masks])
+            self._db.commit()
+
+    def add(self, mask, is_sat):
+        with self._lock:
+            if self._db is None:
+                return
+            self._db.execute("INSERT OR IGNORE INTO results VALUES (?, ?)", ('%x' % mask, int(is_sat)))
+            self._pending += 1
+            if self._pending >= self._batch_size:
+                self._db.commit()
+                self._pending = 0
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+                self._db.close()
+                self._db = None
+
+
 class Z3SubsetSolver(object):
     c_prefix = "!marco"  # to differentiate our vars from instance vars
 
     constraints = []
     n = 0
     s = None
-    varcache = {}
-    idcache = {}
 
-    def __init__(self, filename):
+    # Cores are scanned as bitmasks until a scan is estimated to cost more
+    # than a UBTree lookup; see add_core().
+    core_scan_limit = 900
+
+    def __init__(self, filename, grow_threads=None, cache_dir=None):
         self.read_constraints(filename)
         self.make_solver()
 
+        # grow() checks candidates with this many worker threads
+        # (None = sequentially, 0 = one per CPU)
+        self._grow_threads = grow_threads
+        self._grow_pool = None
+        self._worker_solvers = None
+
+        # results of previous checks, for answering repeated queries
+        # without calling the solver
+        self._unsat_cores = UBTree()  # unsat cores (frozensets of constraint indexes)
+        self._core_masks = []         # the same cores as bitmasks, while scanning them is cheaper
+        self._core_sizes = 0          # total size of those cores
+        self._sat_cache = []          # known satisfiable subsets (bitmasks), newest first
+        self._last_core = None        # core for the most recent unsat check
+
+        self._msolver = None
+
+        # optionally keep those results on disk across runs
+        self._result_cache = None
+        if cache_dir is not None:
+            self._result_cache = ResultCache(cache_dir, filename, self.n)
+            self.load_results()
+
+    def load_results(self):
+        sats = []
+        for mask, is_sat in self._result_cache.load():
+            if is_sat:
+                sats.append(mask)
+            else:
+                self.add_core(frozenset(utils.mask_bits(mask)))
+        # Every satisfiable check is stored, but most are made redundant by
+        # larger ones found later.  Keep only the maximal ones, taking the
+        # largest first so each is added without displacing any kept so far,
+        # and drop the rest from the cache.
+        sats.sort(key=lambda mask: bin(mask).count('1'), reverse=True)
+        kept = []
+        redundant = []
+        for mask in sats:
+            if any(mask | known == known for known in kept):
+                redundant.append(mask)
+            else:
+                kept.append(mask)
+        self._sat_cache = kept
+        if redundant:
+            self._result_cache.remove(redundant)
+
+    def close(self):
+        # write out any results not yet saved to the on-disk cache
+        # (needed where the process exits without running atexit handlers)
+        if self._result_cache is not None:
+            self._result_cache.close()
+
+    def set_msolver(self, msolver):
+        self._msolver = msolver
+
     def read_constraints(self, filename):
         if filename.endswith('.cnf'):
             self.constraints = read_dimacs(filename)
         else:
             self.constraints = read_smt2(filename)
         self.n = len(self.constraints)
+        # subsets are bitmasks internally, with bit i for (1-based) constraint i
+        self._full_mask = ((1 << self.n) - 1) << 1
 
     def make_solver(self):
+        # positive and negative literals for every constraint's variable,
+        # indexed by (1-based) constraint index
+        self._cvar_pos = [None] + [Bool(self.c_prefix + str(i)) for i in range(1, self.n+1)]
+        self._cvar_neg = [None] + [Not(v) for v in self._cvar_pos[1:]]
+        self.idcache = dict((self.get_id(v), i) for i, v in enumerate(self._cvar_pos) if i > 0)
+        self._assumption_buf = []  # reused by check_mask()
+
         self.s = Solver()
         for i in range(self.n):
             v = self.c_var(i+1)
@@ -61,66 +279,199 @@ class Z3SubsetSolver(object):
         return Z3_get_ast_id(x.ctx.ref(),x.as_ast())
 
     def c_var(self, i):
-        if i not in self.varcache:
-            v = Bool(self.c_prefix + str(abs(i)))
-            self.idcache[self.get_id(v)] = abs(i)
-            if i >= 0:
-                self.varcache[i] = v
-            else:
-                self.varcache[i] = Not(v)
-        return self.varcache[i]
+        return self._cvar_pos[i] if i >= 0 else self._cvar_neg[-i]
 
     def check_subset(self, seed, improve_seed=False):
-        assumptions = self.to_c_lits(seed)
-        is_sat = (self.s.check(assumptions) == sat)
+        is_sat = self.check_mask(utils.to_mask(seed))
         if improve_seed:
             if is_sat:
                 # TODO: difficult to do efficiently...
                 #seed = seed_from_model(solver.model(), n)
                 pass
             else:
-                seed = self.seed_from_core()
+                seed = list(self._last_core)
             return is_sat, seed
         else:
             return is_sat
 
-    def to_c_lits(self, seed):
-        return [self.c_var(i) for i in seed]
+    def check_mask(self, mask):
+        core = self.find_core(mask)
+        if core is not None:
+            is_sat = False
+        elif any(mask | known == known for known in self._sat_cache):
+            is_sat = True
+        else:
+            # Subsets are passed as assumptions to the one solver, which
+            # keeps its learned clauses across checks.  (Asserting the
+            # constraints known to stay in shrink()/grow() results in a
+            # push()ed frame instead made Z3 slower and its cores worse.)
+            is_sat = (self.s.check(self.fill_assumptions(mask)) == sat)
+            if is_sat:
+                self.add_sat(mask)
+            else:
+                core = frozenset(self.seed_from_core())
+                self.add_core(core)
+            if self._result_cache is not None:
+                self._result_cache.add(mask if is_sat else utils.to_mask(core), is_sat)
+        self._last_core = core
+        return is_sat
+
+    def find_core(self, mask):
+        # Until the tree is estimated to be cheaper (see add_core()), testing
+        # each core's bitmask against the query directly is faster.
+        if self._core_masks is not None:
+            inv = ~mask
+            for core in self._core_masks:
+                if not core & inv:
+                    return frozenset(utils.mask_bits(core))
+            return None
+        return self._unsat_cores.find_subset(mask)
+
+    def add_core(self, core):
+        self._unsat_cores.insert(core)
+        if self._core_masks is not None:
+            self._core_masks.append(utils.to_mask(core))
+            self._core_sizes += len(core)
+            # A scan costs about (40 + words per mask) units per core, while
+            # a tree lookup walks paths as long as the cores, so its cost
+            # follows their average size.  Measured crossovers: ~400 cores
+            # of ~18 constraints at n=40, while at n=2804 (cores of ~1000)
+            # scanning 611 cores is still ~40x faster than the tree.
+            ncores = len(self._core_masks)
+            if ncores * (40 + self.n // 64 + 1) > self.core_scan_limit * self._core_sizes / ncores:
+                self._core_masks = None
+
+    def add_sat(self, mask):
+        # drop any satisfiable subsets made redundant by the new (larger) one
+        self._sat_cache = [mask] + [x for x in self._sat_cache if x | mask != mask]
+
+    def fill_assumptions(self, mask):
+        # refill one reusable list rather than building a new one per check
+        # (z3 copies the assumptions when check() is called)
+        buf = self._assumption_buf
+        del buf[:]
+        pos = self._cvar_pos
+        while mask:
+            low = mask & -mask
+            buf.append(pos[low.bit_length() - 1])
+            mask ^= low
+        return buf
 
     def complement(self, aset):
-        return set(range(1, self.n+1)).difference(aset)
+        if not isinstance(aset, numbers.Integral):
+            aset = utils.to_mask(aset)
+        return self._full_mask ^ aset
 
     def seed_from_core(self):
         core = self.s.unsat_core()
         return [self.idcache[self.get_id(x)] for x in core]
 
-    def shrink(self, seed, hard=[]):
-        current = set(seed)
-        for i in seed:
-            if i not in current or i in hard:
-                # May have been "also-removed"
-                continue
-            current.remove(i)
-            if not self.check_subset(current):
+    def shrink(self, seed, hard=None):
+        if hard is None:
+            # Prune first: a constraint implied true by the map (a singleton
+            # MCS) is in every unsat subset, so it need not be tested.
+            # (Known MCSes in general only say that *some* of their
+            # constraints are needed, so they can't be used to drop any.)
+            if self._msolver is not None:
+                hard = set(x for x in self._msolver.implies() if x > 0)
+            else:
+                hard = ()
+        current = utils.to_mask(seed)
+        # candidates still to try removing (reversed so pop() takes them in seed order)
+        todo = [i for i in reversed(seed) if i not in hard]
+        # Remove candidates in chunks, one check per chunk: the chunk size
+        # doubles while removals succeed and drops back to single
+        # constraints when one fails.
+        chunk = 1
+        while todo:
+            batch = []
+            while todo and len(batch) < chunk:
+                i = todo.pop()
+                if current >> i & 1:
+                    # (May have been "also-removed" otherwise)
+                    batch.append(i)
+            if not batch:
+                break
+
+            batch_mask = utils.to_mask(batch)
+            if not self.check_mask(current & ~batch_mask):
                 # Remove any also-removed constraints
-                current = set(self.seed_from_core())
+                current = utils.to_mask(self._last_core)
+                chunk *= 2
             else:
-                current.add(i)
-        return current
+                if len(batch) > 1:
+                    # some of the chunk is needed; retry its constraints one by one
+                    todo.extend(reversed(batch))
+                chunk = 1
+        return list(utils.mask_bits(current))
 
     def grow(self, seed):
-        current = seed
+        current = utils.to_mask(seed)
+        candidates = list(utils.mask_bits(self.complement(current)))
 
-        for i in self.complement(current):
+        if self._grow_threads is not None and len(candidates) > 1:
+            current, candidates = self.grow_parallel(current, candidates)
+
+        for i in candidates:
             #if i in current:
             #    # May have been "also-satisfied"
             #    continue
-            current.append(i)
-            if self.check_subset(current):
+            if self.check_mask(current | 1 << i):
+                current |= 1 << i
                 # Add any also-satisfied constraint
                 #current = seed_from_model(s.model(), n)  # still too slow to help here
-                pass
+
+        return list(utils.mask_bits(current))
+
+    def make_workers(self):
+        import concurrent.futures
+        k = self._grow_threads or multiprocessing.cpu_count()
+        # each worker gets its own copy of the solver in its own context,
+        # so the workers can check in parallel
+        self._worker_solvers = []
+        for _ in range(k):
+            ctx = Context()
+            cvars = [None] + [Bool(self.c_prefix + str(i), ctx) for i in range(1, self.n+1)]
+            self._worker_solvers.append((self.s.translate(ctx), cvars))
+        self._grow_pool = concurrent.futures.ThreadPoolExecutor(k)
+
+    @staticmethod
+    def grow_batch(worker, current, batch):
+        # greedily grow current (a bitmask) by the constraints in batch
+        s, cvars = worker
+        assumptions = [cvars[i] for i in utils.mask_bits(current)]
+        added = 0
+        for i in batch:
+            assumptions.append(cvars[i])
+            if s.check(assumptions) == sat:
+                added |= 1 << i
             else:
-                current.pop()
+                assumptions.pop()
+        return added
 
-        return current
+    def grow_parallel(self, current, candidates):
+        """Grow current by splitting candidates among the worker solvers.
+
+        Returns the grown bitmask and the candidates that still have to be
+        checked sequentially against it.
+        """
+        if self._worker_solvers is None:
+            self.make_workers()
+        k = min(len(self._worker_solvers), len(candidates))
+        batches = [candidates[w::k] for w in range(k)]
+        futures = [self._grow_pool.submit(self.grow_batch, self._worker_solvers[w], current, batches[w]) for w in range(k)]
+
+        # Each batch was grown independently from current, so merge them one
+        # at a time.  A batch whose additions are compatible with everything
+        # merged so far is done: its rejected constraints were unsat with a
+        # subset of the result, so they stay unsat.  Otherwise all of its
+        # constraints are rechecked sequentially.
+        grown = current
+        retry = []
+        for batch, future in zip(batches, futures):
+            added = future.result()
+            if added == 0 or self.check_mask(grown | added):
+                grown |= added
+            else:
+                retry.extend(batch)
+        return grown, retry
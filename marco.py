@@ -77,6 +77,10 @@ def parse_args():
                               help="use MUSer2-para in place of MUSer2 to run in parallel (specify # of threads.)")
     exp_group.add_argument('--nomax', action='store_true',
                            help="perform no model maximization whatsoever (applies either shrink() or grow() to all seeds)")
+    exp_group.add_argument('--cache-dir', type=str, default=None,
+                           help="only used for SMT inputs: store the results of Z3 checks in the given directory and reuse them in later runs on the same input.")
+    exp_group.add_argument('--parallel-grow', type=int, nargs='?', const=0, default=None,
+                           help="only used for SMT inputs and *not* with --parallel: check the candidates in grow() using the given number of threads, each with its own Z3 solver [default: one per CPU if --parallel-grow specified without a count].")
 
     args = parser.parse_args()
 
@@ -165,7 +169,7 @@ def setup_execution(args, stats, mainpid):
         atexit.register(at_exit, stats)
 
 
-def setup_csolver(args, seed):
+def setup_csolver(args, seed, use_cache=True):
     infile = args.infile
 
     # create appropriate constraint solver
@@ -197,7 +201,8 @@ def setup_csolver(args, seed):
             error_exit("Unable to import z3 module.", "Please install Z3 from https://github.com/Z3Prover/z3", e)
         # z3 has to be given a filename, not a file object, so close infile and just pass its name
         infile.close()
-        csolver = Z3SubsetSolver(infile.name)
+        cache_dir = args.cache_dir if use_cache else None
+        csolver = Z3SubsetSolver(infile.name, args.parallel_grow, cache_dir)
     else:
         sys.stderr.write(
             "Cannot determine filetype (cnf or smt) of input: %s\n"
@@ -243,6 +248,7 @@ def setup_config(args):
     config = {}
     config['bias'] = args.bias
     config['comms_ignore'] = args.comms_ignore
+    config['comms_disable'] = args.comms_disable
     if args.nomax:
         config['maximize'] = False
     else:
@@ -267,7 +273,7 @@ def run_enumerator(stats, args, seed=None, pipe=None):
         remaining = args.limit
         for result in enumerator.enumerate():
             if pipe:
-                pipe.send(result)
+                pipe.send_bytes(utils.pack_message(result))
             else:
                 print_result(result, args, stats, csolver.n)
                 if remaining:
@@ -294,9 +300,11 @@ def run_master(stats, args, pipes):
     # suddenly becomes blocked by new blocking clauses, it could return that incorrectly
     # as an MUS or MCS)
     # Need to parse the constraint set (again!) just to get n for the map formula...
-    csolver = setup_csolver(args, seed=None)
+    # (but not to load its cached results, which the hub never uses)
+    csolver = setup_csolver(args, seed=None, use_cache=False)
     msolver = mapsolvers.MinisatMapSolver(csolver.n)
-    # Old way: results = set()
+    # packed bitmasks of all results reported so far
+    results = set()
 
     remaining = args.limit
 
@@ -307,12 +315,13 @@ def run_master(stats, args, pipes):
                 while receiver.poll():
                     try:
                         # get a result
-                        result = receiver.recv()
+                        data = receiver.recv_bytes()
                     except EOFError:
                         # Sometimes a closed pipe will still trigger ready and .poll(),
-                        # but it then throws an EOFError on .recv().  Handle that here.
+                        # but it then throws an EOFError on .recv_bytes().  Handle that here.
                         pipes.remove(receiver)
                         break
+                    result = utils.unpack_message(data)
 
                     if result[0] == 'done':
                         # "done" indicates the child process has finished its work,
@@ -321,7 +330,7 @@ def run_master(stats, args, pipes):
                         if args.verbose > 1:
                             print("Child (%s) sent 'done'." % receiver)
                         # Terminate the child process.
-                        receiver.send('terminate')
+                        receiver.send_bytes(utils.pack_message('terminate'))
                         # Remove it from the list of active pipes
                         pipes.remove(receiver)
 
@@ -338,7 +347,7 @@ def run_master(stats, args, pipes):
 
                         # End / cleanup all children
                         for pipe in pipes:
-                            pipe.send('terminate')
+                            pipe.send_bytes(utils.pack_message('terminate'))
                         # Exit main process
                         sys.exit(0)
 
@@ -346,7 +355,9 @@ def run_master(stats, args, pipes):
                         assert result[0] in ['U', 'S']
                         # filter out duplicate / spurious results
                         with stats.time('msolver'):
-                            if not msolver.check_seed(result[1]):
+                            # exact duplicates are caught by their packed bitmask
+                            # without querying the map solver
+                            if data in results or not msolver.check_seed(result[1]):
                                 if args.verbose > 1:
                                     print("Child (%s) sent duplicate (len: %d)" % (receiver, len(result[1])))
                                 if result[0] == 'U':
@@ -363,13 +374,7 @@ def run_master(stats, args, pipes):
                             elif result[0] == 'S':
                                 msolver.block_down(result[1])
 
-                        # Old way to check duplicates:
-                        #res_set = frozenset(result[1])
-                        #res_set = ",".join(str(x) for x in result[1])
-                        #if res_set in results:
-                        #    continue
-
-                        #results.add(res_set)
+                        results.add(data)
 
                         print_result(result, args, stats, csolver.n)
 
@@ -379,15 +384,16 @@ def run_master(stats, args, pipes):
                                 sys.stderr.write("Result limit reached.\n")
                                 # End / cleanup all children
                                 for pipe in pipes:
-                                    pipe.send('terminate')
+                                    pipe.send_bytes(utils.pack_message('terminate'))
                                 # Exit main process
                                 sys.exit(0)
 
                         if not args.comms_disable:
                             # send it to all children *other* than the one we got it from
+                            # (forwarding the packed message as received)
                             for other in pipes:
                                 if other != receiver:
-                                    other.send(result)
+                                    other.send_bytes(data)
 
 
 def print_result(result, args, stats, num_constraints):
@@ -418,6 +424,9 @@ def main():
         setup_execution(args, stats, os.getpid())
         if args.same_seeds or args.comms_disable:
             assert args.parallel is not None, "some flags you have specified have to be tested in the parallel mode."
+        if args.parallel_grow is not None:
+            assert args.parallel is None, "--parallel-grow cannot be combined with --parallel."
+            assert args.parallel_grow >= 0, "--parallel-grow needs a number of threads >= 0 (0 = one per CPU)."
 
         if args.parallel:
             for i, mode in enumerate(args.parallel.split(',')):
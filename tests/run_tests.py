@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # run_tests.py -- Run regression tests
 #
@@ -6,33 +6,36 @@
 # Date: October 2012
 #
 
+import filecmp
+import functools
+import hashlib
 import json
 import math
+import multiprocessing
 import os
 import re
+import shutil
 import sys
 import subprocess
 import tempfile
 import time
-from collections import defaultdict
-try: from Queue import Empty  # Python 2
-except ImportError: from queue import Empty  # Python 3
-from multiprocessing import Process, Queue, cpu_count
-
-# pull in configuration from testconfig.py
-import testconfig
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+try: import orjson  # faster JSON, if available
+except ImportError: orjson = None
 
 # globals (w/ default values)
 mode = 'runp'
 verbose = False
-
-# hack to work in both python 2 and 3
-try: input = raw_input
-except NameError: pass
+shared = None  # (state, runtimes, notify) in pool workers
 
 
 # Build all tests to be run
 def makeTests(testname):
+    # pull in configuration from testconfig.py (only here, in the main
+    # process, so that spawned workers don't rescan the test files)
+    import testconfig
+
     tests = []
 
     for job in testconfig.jobs:
@@ -47,7 +50,7 @@ def makeTests(testname):
         files = job['files']
         flags = job.get('flags', [''])
         flags_all = job.get('flags_all', [])
-        exclude = job.get('exclude', [])
+        exclude = frozenset(job.get('exclude', ()))
         out_filter = job.get('out_filter', None)
 
         outdir = "out/" + name + "/"
@@ -67,41 +70,131 @@ def makeTests(testname):
                 outfile = outdir + infile + ".out"
                 errfile = outdir + infile + ".err"
 
-                tests.append( {'cmdarray': cmdarray + [infile], 'outfile': outfile, 'errfile': errfile, 'out_filter': out_filter } )
+                # cmdkey identifies the test in the timing data
+                cmd = cmdarray + [infile]
+                tests.append( {'cmdarray': cmd, 'cmdkey': " ".join(cmd), 'outfile': outfile, 'errfile': errfile, 'out_filter': out_filter } )
 
     return tests
 
 
-def runTests(jobq, msgq, pid):
-    while True:
-        try:
-            # Block with a small timeout, because the non-blocking get_nowait()
-            # sometimes thinks the Queue is empty when it's not...
-            job = jobq.get(True, 0.1)
-        except Empty:
-            break
-        msgq.put((job['id'], 'start', None))
-        result, runtime = runTest(job['cmdarray'], job['outfile'], job['errfile'], pid, job['out_filter'])
-        if result == 'interrupted':
-            msgq.put((None, 'done', None))
-            return
-        msgq.put((job['id'], result, runtime))
-    msgq.put((None, 'done', None))
+def setGlobals(newmode, newverbose, newshared=None):
+    # (for worker processes, in case they did not inherit them by forking)
+    global mode, verbose, shared
+    mode = newmode
+    verbose = newverbose
+    shared = newshared
+
+
+def runJob(job):
+    result, runtime = runTest(job['cmdarray'], job['outfile'], job['errfile'], os.getpid(), job['out_filter'], job.get('golden_hash'))
+    return job['id'], result, runtime
+
+
+# Test states as stored in the shared state array (any other result is
+# stored as a failure).
+states = ('queued', 'start', 'pass', 'sortsame', 'stderr', 'interrupted', 'fail')
+state_code = dict((name, code) for code, name in enumerate(states))
+
+
+def runSharedJob(job):
+    # Report through shared memory instead of through the result pipe:
+    # one store per event, and a semaphore to wake the parent.
+    state, runtimes, notify = shared
+    testid = job['id']
+    state[testid] = state_code['start']
+    notify.release()
+    testid, result, runtime = runJob(job)
+    runtimes[testid] = runtime or 0.0
+    state[testid] = state_code.get(result, state_code['fail'])
+    notify.release()
+
+
+def runPool(jobs, num_procs, prog, td):
+    # Fork workers where possible: it is cheaper than spawning them and
+    # re-importing this module in each.
+    try:
+        context = multiprocessing.get_context('fork')
+    except ValueError:
+        context = None
+    ctx = context or multiprocessing
+
+    # Workers write each test's state and runtime into these slots; the
+    # parent polls them whenever it is notified.
+    numTests = len(jobs)
+    state = ctx.Array('b', numTests, lock=False)
+    runtimes = ctx.Array('d', numTests, lock=False)
+    notify = ctx.Semaphore(0)
+
+    pool = ProcessPoolExecutor(max_workers=num_procs, mp_context=context,
+                               initializer=setGlobals, initargs=(mode, verbose, (state, runtimes, notify)))
+    try:
+        futures = [pool.submit(runSharedJob, job) for job in jobs]
+
+        seen = [state_code['queued']] * numTests
+        unfinished = list(range(numTests))
+        while unfinished:
+            prog.flush()
+            if not notify.acquire(timeout=1.0):
+                # nothing reported lately; if every job is done anyway, a
+                # worker must have died or raised -- surface its error
+                if all(future.done() for future in futures):
+                    for future in futures:
+                        future.result()
+                    break
+                continue
+            # one scan covers every event reported so far
+            while notify.acquire(False):
+                pass
+
+            still_running = []
+            for testid in unfinished:
+                code = state[testid]
+                if code != seen[testid]:
+                    seen[testid] = code
+                    result = states[code]
+                    if result == 'start':
+                        prog.update(testid, result)
+                    elif result != 'interrupted':
+                        runtime = runtimes[testid]
+                        if runtime:
+                            td.store_time(jobs[testid]['cmdkey'], runtime)
+                        prog.update(testid, result)
+                if code <= state_code['start']:
+                    still_running.append(testid)
+            unfinished = still_running
+    except KeyboardInterrupt:
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+
+def timedRun(cmd, stdout, stderr):
+    # close_fds=False skips closing every other descriptor in the child
+    # (and lets subprocess use its faster spawn paths); descriptors opened
+    # by Python are non-inheritable anyway, so nothing leaks into tests
+    start_time = time.perf_counter()  # monotonic, high-resolution wall-clock time
+    ret = subprocess.run(cmd, stdout=stdout, stderr=stderr, check=False, close_fds=False).returncode
+    return ret, time.perf_counter() - start_time
 
 
 # pid is so different processes don't overwrite each other's tmp files
-def runTest(cmd, outfile, errfile, pid, out_filter=None):
+def runTest(cmd, outfile, errfile, pid, out_filter=None, golden_hash=None):
     global mode, verbose
 
     if mode == "nocheck":
         tmpout = os.devnull
         tmperr = os.devnull
+        tmpfiles = []
     elif mode == "regenerate":
-        tmpout = outfile
+        # written next to the output file and moved into place when done,
+        # so an interrupted run leaves the old output intact
+        tmpout = outfile + ".tmp"
         tmperr = os.devnull
+        tmpfiles = [tmpout]
     else:
         tmpout = outfile + ".NEW" + str(pid)
         tmperr = errfile + str(pid)
+        tmpfiles = [tmpout, tmperr]
         if not os.path.exists(outfile):
             if verbose:
                 print("\n[33mKnown-good output does not exist:[0m %s\nPlease run in '[34;1mregenerate[0m' mode first." % outfile)
@@ -110,87 +203,148 @@ def runTest(cmd, outfile, errfile, pid, out_filter=None):
     if verbose:
         print("\n[34;1mRunning test:[0m %s > %s 2> %s" % (" ".join(cmd), tmpout, tmperr))
 
-    with open(tmpout, 'w') as f_out, open(tmperr, 'w') as f_err:
+    # remove any temporary files however the test ends
+    try:
         try:
-            start_time = time.time()  # time() for wall-clock time
-            ret = subprocess.call(cmd, stdout=f_out, stderr=f_err)
-            runtime = time.time() - start_time
+            if mode == "nocheck":
+                # output is discarded, so no files are needed
+                ret, runtime = timedRun(cmd, subprocess.DEVNULL, subprocess.DEVNULL)
+                errsize = 0
+            else:
+                # binary, since the child writes bytes (no text layer needed), with a
+                # large buffer for anything written through the file objects
+                with open(tmpout, 'wb', buffering=131072) as f_out, open(tmperr, 'wb', buffering=131072) as f_err:
+                    ret, runtime = timedRun(cmd, f_out, f_err)
+                    # the child shares the file offset, so this is how much it wrote
+                    errsize = f_err.tell()
         except KeyboardInterrupt:
-            os.remove(tmpout)
-            os.remove(tmperr)
             return 'interrupted', None
 
-    if ret > 128:
-        return 'fail', None
-
-    if mode == "nocheck" or mode == "regenerate":
-        return 'pass', runtime
+        if ret > 128:
+            return 'fail', None
 
-    result = checkFiles(outfile, tmpout, out_filter)
-    if result != 'pass' and result != 'sortsame':
-        # don't report/store a runtime for failures
-        runtime = None
+        if mode == "nocheck":
+            return 'pass', runtime
+        if mode == "regenerate":
+            os.replace(tmpout, outfile)
+            return 'pass', runtime
 
-    if verbose:
-        if result == 'pass':
-            errsize = os.path.getsize(tmperr)
-            if errsize:
-                print("  [32mTest passed (with output to stderr).[0m")
-                result = 'stderr'
-            else:
-                print("  [32mTest passed.[0m")
-        elif result == 'sortsame':
-            print("  [33mOutputs not equivalent, but sort to same contents.[0m")
+        if goldenMatches(outfile, golden_hash, tmpout):
+            # identical to the known-good output (read only the new output)
+            result = 'pass'
         else:
-            print("\n  [37;41mTest failed:[0m %s" % " ".join(cmd))
-            errsize = os.path.getsize(tmperr)
-            if errsize:
-                print("  [31mStderr output:[0m")
-                with open(tmperr, 'r') as f:
-                    for line in f:
-                        print("    " + line.rstrip())
-            viewdiff(outfile, tmpout)
-            updateout(outfile, tmpout)
+            result = checkFiles(outfile, tmpout, out_filter)
+        if result != 'pass' and result != 'sortsame':
+            # don't report/store a runtime for failures
+            runtime = None
 
-    try:
-        os.remove(tmpout)
-        os.remove(tmperr)
-    except OSError:
-        pass
-    return result, runtime
+        if verbose:
+            if result == 'pass':
+                if errsize:
+                    print("  [32mTest passed (with output to stderr).[0m")
+                    result = 'stderr'
+                else:
+                    print("  [32mTest passed.[0m")
+            elif result == 'sortsame':
+                print("  [33mOutputs not equivalent, but sort to same contents.[0m")
+            else:
+                print("\n  [37;41mTest failed:[0m %s" % " ".join(cmd))
+                if errsize:
+                    print("  [31mStderr output:[0m")
+                    with open(tmperr, 'r') as f:
+                        for line in f:
+                            print("    " + line.rstrip())
+                viewdiff(outfile, tmpout)
+                updateout(outfile, tmpout)
+
+        return result, runtime
+    finally:
+        for filename in tmpfiles:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass  # (never created, or already moved into place)
+
+
+def hashFile(filename):
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(131072), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# golden_hash is (mtime, size, digest) of the known-good output when it was
+# hashed; it only applies while the file is unchanged, since updateout()
+# may have replaced it since.
+def goldenMatches(outfile, golden_hash, newfile):
+    if golden_hash is None:
+        return False
+    mtime, size, digest = golden_hash
+    stat = os.stat(outfile)
+    if stat.st_mtime != mtime or stat.st_size != size:
+        return False
+    return hashFile(newfile) == digest
+
+
+@functools.lru_cache(maxsize=256)
+def loadGolden(filename, mtime, size):
+    # Known-good outputs are shared by the tests of every flag combination
+    # for an input, so each worker keeps those it has read.  (mtime and size
+    # are part of the key so regenerated outputs are read again.)
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def readData(filename, out_filter=None, golden=False):
+    # read a file's contents as bytes, dropping any lines that match out_filter
+    if golden:
+        stat = os.stat(filename)
+        data = loadGolden(filename, stat.st_mtime, stat.st_size)
+    else:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    if out_filter is not None:
+        data = re.sub(b"^.*" + out_filter.encode() + b".*\n", b'', data, flags=re.MULTILINE)
+    return data
 
 
 def checkFiles(file1, file2, out_filter=None):
     global verbose
 
-    with open(file1) as f1:
-        data1 = f1.read()
-        if out_filter is not None:
-            data1 = re.sub("^.*%s.*\n" % out_filter, '', data1, flags=re.MULTILINE)
-    with open(file2) as f2:
-        data2 = f2.read()
-        if out_filter is not None:
-            data2 = re.sub("^.*%s.*\n" % out_filter, '', data2, flags=re.MULTILINE)
+    if out_filter is None:
+        # compare the files directly, without reading them into memory
+        samesize = os.path.getsize(file1) == os.path.getsize(file2)
+        if samesize and filecmp.cmp(file1, file2, shallow=False):
+            return 'pass'
+    else:
+        samesize = True  # (checked once filtered)
+
+    if samesize:
+        data1 = readData(file1, out_filter, golden=True)
+        data2 = readData(file2, out_filter)
+        samesize = len(data1) == len(data2)
 
-    if len(data1) != len(data2):
+    if not samesize:
         if verbose:
             print("\n  [31mOutputs differ (size).[0m")
         return 'diffsize'
 
-    if data1 != data2:
-        # test sorted lines
-        sort1 = data1.split('\n').sort()
-        sort2 = data2.split('\n').sort()
-        if sort1 != sort2:
-            if verbose:
-                print("\n  [31mOutputs differ (contents).[0m")
-            return 'diffcontent'
-        else:
-            # outputs not equivalent, but sort to same contents
-            return 'sortsame'
+    if data1 == data2:
+        # (only possible after filtering)
+        return 'pass'
 
-    # everything checks out
-    return 'pass'
+    # test sorted lines (and sorted within lines: each result is a set,
+    # so its constraints may be printed in any order)
+    lines1 = sorted(b" ".join(sorted(line.split())) for line in data1.splitlines())
+    lines2 = sorted(b" ".join(sorted(line.split())) for line in data2.splitlines())
+    if lines1 != lines2:
+        if verbose:
+            print("\n  [31mOutputs differ (contents).[0m")
+        return 'diffcontent'
+    else:
+        # outputs not equivalent, but sort to same contents
+        return 'sortsame'
 
 
 # TODO: read single keypress, like "read -n 1" in old bash script, for viewdiff and updateout
@@ -198,14 +352,14 @@ def checkFiles(file1, file2, out_filter=None):
 def viewdiff(f1, f2):
     choice = input("  View diff? (T for terminal, V for vimdiff, S for sorted vimdiff, other for no) ")
     if choice.lower() == 'v':
-        subprocess.call(["vimdiff", f1, f2])
+        subprocess.run(["vimdiff", f1, f2])
     elif choice.lower() == 't':
-        subprocess.call(["diff", f1, f2])
+        subprocess.run(["diff", f1, f2])
     elif choice.lower() == 's':
         with tempfile.NamedTemporaryFile('wb') as tmp1, tempfile.NamedTemporaryFile('wb') as tmp2:
-            subprocess.call(["sort", f1], stdout=tmp1)
-            subprocess.call(["sort", f2], stdout=tmp2)
-            subprocess.call(["vimdiff", tmp1.name, tmp2.name])
+            subprocess.run(["sort", f1], stdout=tmp1)
+            subprocess.run(["sort", f2], stdout=tmp2)
+            subprocess.run(["vimdiff", tmp1.name, tmp2.name])
 
 
 def updateout(outfile, newoutput):
@@ -234,11 +388,11 @@ class Progress:
         }
 
         self.do_print = do_print
+        self.unflushed = 0  # updates written since the last flush
 
         if self.do_print:
-            # get size of terminal (thanks: stackoverflow.com/questions/566746/)
-            self.rows, self.cols = os.popen('stty size', 'r').read().split()
-            self.cols = int(self.cols)
+            # get size of terminal (without running stty in a shell)
+            self.cols, self.rows = shutil.get_terminal_size((80, 24))
 
             # figure size of printed area
             self.printrows = int(math.ceil(float(numTests) / (self.cols-2)))
@@ -251,6 +405,7 @@ class Progress:
                 x = i % (self.cols-2) + 2
                 y = i // (self.cols-2)
                 self.print_at(x, self.printrows-y, '.')
+            self.flush()
 
     def update(self, testid, result):
         # print correct mark, update stats
@@ -278,8 +433,13 @@ class Progress:
             x = testid % (self.cols-2) + 2
             y = testid // (self.cols-2)
             self.print_at(x, self.printrows-y, c)
+            # failures are worth seeing right away; otherwise flush
+            # periodically (and whenever the runner is about to wait)
+            if c == self.chr_Fail or c == self.chr_StdErr or self.unflushed >= 16:
+                self.flush()
 
     def printstats(self):
+        self.flush()
         print('')
         if self.stats['incomplete'] > 0:
             # red text
@@ -304,45 +464,71 @@ class Progress:
     # x is 1-based
     # y is 0-based, with 0 = lowest row, 1 above that, etc.
     def print_at(self, x, y, string):
-        # move to correct position
-        sys.stdout.write("[%dF" % y)  # y (moves to start of row)
-        sys.stdout.write("[%dG" % x)         # x
+        # move to row y (at its start), then column x, print, move back
+        # down, and move the cursor to the side -- all in one write
+        sys.stdout.write("[%dF[%dG%s[%dE[0G" % (y, x, string, y))
+        self.unflushed += 1
+
+    def flush(self):
+        if self.do_print and self.unflushed:
+            sys.stdout.flush()
+            self.unflushed = 0
+
 
-        sys.stdout.write(string)
+def loadJSON(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode('utf-8'))
 
-        # move back down
-        sys.stdout.write("[%dE" % y)
 
-        # move cursor to side and flush anything pending
-        sys.stdout.write("[0G")
-        sys.stdout.flush()
+def dumpJSON(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
 
 
 class TimeData:
     def __init__(self, filename="runtimes.json"):
         self.filename = filename
         try:
-            with open(self.filename, 'r') as f:
-                data = f.read()
-            self.times = defaultdict(int, json.loads(data))
+            with open(self.filename, 'rb') as f:
+                data = loadJSON(f.read())
+            if 'times' not in data:
+                # older files hold only the times
+                data = {'times': data}
+            self.times = dict(data['times'])
+            self.hashes = data.get('hashes', {})
             self.have_times = True
         except:
             #print "No timing data found.  Timing data will be regenerated."
-            self.times = defaultdict(int)
+            self.times = {}
+            self.hashes = {}
             self.have_times = False
 
+    # Longest first, so the slowest tests don't end up running alone at the
+    # end; workers take jobs in order, so each goes to the next free worker.
+    # (unknown commands count as 0 without being added to the stored times)
     def sort_by_time(self, jobs):
-        return sorted(jobs, key=lambda x: self.times[" ".join(x['cmdarray'])])
+        return sorted(jobs, key=lambda x: -self.times.get(x['cmdkey'], 0.0))
 
-    def get_time(self, cmdarray):
-        return self.times[" ".join(cmdarray)]
+    def get_time(self, cmdkey):
+        return self.times.get(cmdkey, 0.0)
 
-    def store_time(self, cmdarray, runtime):
-        self.times[" ".join(cmdarray)] = runtime
+    def store_time(self, cmdkey, runtime):
+        self.times[cmdkey] = runtime
+
+    def get_hash(self, filename):
+        # hashes of known-good outputs are kept with their mtime and size,
+        # and only recomputed when those change; returns (mtime, size, digest)
+        stat = os.stat(filename)
+        entry = self.hashes.get(filename)
+        if entry is None or entry[0] != stat.st_mtime or entry[1] != stat.st_size:
+            entry = self.hashes[filename] = [stat.st_mtime, stat.st_size, hashFile(filename)]
+        return tuple(entry)
 
     def save_data(self):
-        with open(self.filename, 'w') as f:
-            f.write(json.dumps(self.times))
+        with open(self.filename, 'wb') as f:
+            f.write(dumpJSON({'times': self.times, 'hashes': self.hashes}))
 
 
 def main():
@@ -386,11 +572,15 @@ def main():
     # build the tests
     jobs = makeTests(testname)
     numTests = len(jobs)
-    # sort by times, if we have them
+    # sort by times (longest first), if we have them
     jobs = td.sort_by_time(jobs)
     # give each an increasing 'id'
     for idx, job in enumerate(jobs):
         job['id'] = idx
+        # outputs can be checked against a hash of the known-good output
+        # when they are compared unfiltered
+        if mode in ('run', 'runp') and job['out_filter'] is None and os.path.exists(job['outfile']):
+            job['golden_hash'] = td.get_hash(job['outfile'])
 
     # say what we are about to do
     if testname is None:
@@ -403,39 +593,26 @@ def main():
     if mode == 'regenerate':
         report += " (to regenerate output files)"
     if td.have_times:
-        report += " (sorted by previously recorded runtimes)"
+        report += " (longest first, by previously recorded runtimes)"
     report += "."
     print(report)
 
-    # run the tests
-    jobq = Queue()  # jobs *to* each process
-    for job in jobs:
-        jobq.put(job)
-    msgq = Queue()  # messages *from* each process
-
-    # wait for completion, printing progress/stats as needed
+    # run the tests, printing progress/stats as needed
     # if verbose is on, printing the progress bar is not needed/wanted
     prog = Progress(numTests, do_print=(not verbose))
 
     try:
         if verbose:
             # run in same process so viewdiff, etc. can get stdin
-            runTests(jobq, msgq, 1)
-        else:
-            for pid in range(num_procs):
-                p = Process(target=runTests, args=(jobq, msgq, pid,))
-                p.daemon = True
-                p.start()
-
-        procs_done = 0
-        while procs_done < num_procs:
-            testid, result, runtime = msgq.get()
-            if result == 'done':
-                procs_done += 1
-            else:
+            for job in jobs:
+                testid, result, runtime = runJob(job)
+                if result == 'interrupted':
+                    break
                 if runtime:
-                    td.store_time(jobs[testid]['cmdarray'], runtime)
+                    td.store_time(job['cmdkey'], runtime)
                 prog.update(testid, result)
+        else:
+            runPool(jobs, num_procs, prog, td)
 
     except KeyboardInterrupt:
         print('')
@@ -2,8 +2,11 @@
 # Syntax: Python
 
 import glob
+import os
+import shutil
 import subprocess
 import sys
+import tempfile
 
 interpreter = sys.executable  # use whatever interpreter is running this script
 cmd = '../marco.py'
@@ -25,20 +28,36 @@ if ret > 0:
 else:
     muser_available = True
 
-# collect test instances
+# collect test instances (in one pass over the directory)
+files_by_ext = {'.cnf': [], '.gcnf': [], '.gz': [], '.smt2': []}
+with os.scandir('.') as entries:
+    for entry in entries:
+        ext = os.path.splitext(entry.name)[1]
+        if ext in files_by_ext and not entry.name.startswith('.'):
+            files_by_ext[ext].append(entry.name)
 reg_files = []
-reg_files.extend(glob.glob('*.cnf'))
-reg_files.extend(glob.glob('*.gcnf'))
-reg_files.extend(glob.glob('*.gz'))
+reg_files.extend(files_by_ext['.cnf'])
+reg_files.extend(files_by_ext['.gcnf'])
+reg_files.extend(files_by_ext['.gz'])
 # check for z3, add SMT files if available
 try:
     import z3  # noqa
-    reg_files.extend(glob.glob('*.smt2'))
+    reg_files.extend(files_by_ext['.smt2'])
+    smt_files = tuple(files_by_ext['.smt2'])
 except ImportError:
+    smt_files = ()
     print("Unable to import z3 module.\n[33m  Skipping SMT tests.[m")
     print("")
 
-rnd3sat_files = glob.glob('3sat_n10/*.cnf')
+# (tuples: built once, then shared read-only by every job)
+reg_files = tuple(reg_files)
+rnd3sat_files = tuple(glob.glob('3sat_n10/*.cnf'))
+
+# scratch directory for the --cache-dir tests, emptied on every run: the
+# first test of each file to run starts with an empty cache and fills it,
+# and the others start from what it (and any earlier ones) stored
+cache_dir = os.path.join(tempfile.gettempdir(), 'marco_test_cache')
+shutil.rmtree(cache_dir, ignore_errors=True)
 
 jobs = [
     # Random 3SAT
@@ -66,6 +85,23 @@ jobs = [
       'exclude': ['c10.cnf', 'dlx2_aa.cnf'],
       'default': True,
     },
+    # --cache-dir (SMT only)
+    {
+      'name':    'marco_py',
+      'files':   smt_files,
+      'flags':   ['--cache-dir ' + cache_dir, '-b MCSes --cache-dir ' + cache_dir, '--parallel MUS,MUS --cache-dir ' + cache_dir],
+      'flags_all': common_flags,
+      'default': True,
+    },
+    # --parallel-grow (SMT only; grow() only runs on non-maximal seeds,
+    # which the map solver produces when biased toward MCSes or with --nomax)
+    {
+      'name':    'marco_py',
+      'files':   smt_files,
+      'flags':   ['-b MCSes --parallel-grow 2', '--nomax --parallel-grow 2'],
+      'flags_all': common_flags,
+      'default': True,
+    },
 ]
 if muser_available:
     jobs.extend([
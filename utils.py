@@ -1,6 +1,10 @@
 """Utility class(es) for marco_py"""
 from collections import Counter, defaultdict
+import binascii
+import functools
+import operator
 import os
+import pickle
 import subprocess
 import threading
 import types
@@ -53,6 +57,58 @@ def synchronize_class(sync_class):
     return sync_class
 
 
+def to_mask(aset):
+    """Convert a collection of non-negative ints to an int bitmask.
+
+    >>> bin(to_mask([1, 3, 4]))
+    '0b11010'
+    """
+    return functools.reduce(operator.or_, (1 << i for i in aset), 0)
+
+
+def mask_bits(mask):
+    """Iterate over the set bits of a bitmask in increasing order.
+
+    >>> list(mask_bits(0b11010))
+    [1, 3, 4]
+    """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+# Results passed between processes in parallel mode are sent as a tag
+# byte followed by the bitmask of their constraints, avoiding pickle.
+# Every other message is pickled (and a pickle never starts with a tag).
+_RESULT_TAGS = (b'U', b'S')
+
+
+def pack_message(msg):
+    """Serialize a message for Connection.send_bytes().
+
+    >>> unpack_message(pack_message(('U', [4, 1, 3])))
+    ('U', [1, 3, 4])
+    >>> unpack_message(pack_message(('complete', None)))
+    ('complete', None)
+    """
+    if isinstance(msg, tuple) and msg[0] in ('U', 'S'):
+        hexmask = '%x' % to_mask(msg[1])
+        if len(hexmask) % 2:
+            hexmask = '0' + hexmask
+        return msg[0].encode() + binascii.unhexlify(hexmask)
+    return pickle.dumps(msg, 2)
+
+
+def unpack_message(data):
+    """Deserialize a message received with Connection.recv_bytes()."""
+    tag = data[:1]
+    if tag in _RESULT_TAGS:
+        mask = int(binascii.hexlify(data[1:]), 16)
+        return (tag.decode(), list(mask_bits(mask)))
+    return pickle.loads(data)
+
+
 class ExecutableException(Exception):
     pass
 